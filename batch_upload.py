@@ -3,20 +3,91 @@
 
 import argparse
 import asyncio
+import atexit
 import csv
+import io
+import logging
+import mmap
 import os
+import re
 import sqlite3
 import time
-from queue import Empty, Queue
-from threading import Event, Thread, current_thread
-
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from queue import Queue
+from logging.handlers import QueueHandler, QueueListener
+from threading import Event, Thread, local
+from urllib.parse import quote_plus
+
+import aiofiles
 import aiohttp
 import documentcloud
 from documentcloud.exceptions import APIError
 from documentcloud.toolbox import grouper
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
+from urllib3.util.retry import Retry
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.csv
+except ImportError:
+    # pyarrow is optional - fall back to the csv module if it is not installed
+    pyarrow = None
+
+logger = logging.getLogger("batch_upload")
 
 SENTINEL = object()
+# size of the chunks to stream files to S3 in
+CHUNK_SIZE = 1 << 20
+# maximum number of simultaneous uploads to S3
+MAX_CONCURRENT_PUTS = 16
+# large files can take a long time to upload, so do not limit the total time of
+# an upload, only how long we wait to connect and for S3 to respond
+S3_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=60, sock_read=600)
+# number of database rows to buffer in each upload thread before writing them
+WRITE_BUFFER_SIZE = 256
+# maximum number of seconds to keep rows in the buffer before writing them
+WRITE_BUFFER_TIME = 10
+# how often, in seconds, a thread waiting on the queue checks if it should stop
+QUEUE_TIMEOUT = 1.0
+
+# the SQL statements are kept as constants, so that sqlite's statement cache
+# can reuse the compiled statements for every batch
+# mark a document as uploaded
+SQL_UPLOADED = (
+    "INSERT INTO documents(document_number, uploaded, error) VALUES(?, 1, 0) "
+    "ON CONFLICT (document_number) DO UPDATE SET uploaded=excluded.uploaded"
+)
+# mark an existing document as uploaded
+SQL_SET_UPLOADED = "UPDATE documents SET uploaded = 1 WHERE document_number = ?"
+# increment the error count for an existing document
+SQL_INCREMENT_ERROR = "UPDATE documents SET error = error + 1 WHERE document_number = ?"
+# increment the error count for a document
+SQL_ERROR = (
+    "INSERT INTO documents(document_number, uploaded, error) VALUES(?, 0, 1) "
+    "ON CONFLICT (document_number) DO UPDATE SET error=error+1"
+)
+# record the error message for a document's latest attempt
+SQL_ERROR_MSG = (
+    "INSERT INTO document_errors "
+    "SELECT document_number, error, ? FROM documents "
+    "WHERE document_number = ?"
+)
+# number of bytes of the CSV for pyarrow to parse at once
+CSV_BLOCK_SIZE = 8 << 20
+# number of document numbers to look up in the database at once
+LOOKUP_SIZE = 500
+# number of searches to run at once when checking on files with errors
+SEARCH_WORKERS = 16
+# maximum number of document numbers to search for in a single search
+SEARCH_SIZE = 200
+# maximum length of the URL encoded search query, to stay well within the URL
+# length limits of the servers and proxies in front of the API
+SEARCH_QUERY_SIZE = 4000
+# number of documents to delete in a single API call
+DELETE_SIZE = 100
 
 
 class BatchUploader:
@@ -24,56 +95,293 @@ class BatchUploader:
 
     def __init__(self):
         self.headers = None
+        self.name_index = None
+        self.title_index = None
+        self.metadata_columns = None
         self.args = None
+        self.csv_index = None
+        self.csv_index_mtime = None
+        self.csv_scanned = False
+        # each upload thread keeps its own event loop and aiohttp session
+        self.local = local()
 
     def name_col_index(self):
-        return self.headers.index(self.args.name_col)
+        return self.name_index
+
+    def set_headers(self, headers):
+        """Set the CSV headers, and precompute the column positions used to
+        convert each row in to the upload parameters
+        """
+        self.headers = headers
+        self.name_index = headers.index(self.args.name_col)
+        self.title_index = headers.index("title")
+        self.metadata_columns = tuple(
+            (i, header) for i, header in enumerate(headers) if header != "title"
+        )
+
+    def connect_db(self):
+        """
+        Connect to the sqlite database
+
+        The connection is in autocommit mode, so that each batch can explicitly
+        group its writes in to a single transaction.  WAL mode lets the upload
+        threads read while another thread is writing, and synchronous=NORMAL
+        only syncs on WAL checkpoints instead of on every commit.  WAL mode is
+        stored in the database file, but the other settings are per connection,
+        so all connections should be opened here.
+        """
+        con = sqlite3.connect(self.args.db_name, isolation_level=None)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute("PRAGMA temp_store=MEMORY")
+        con.execute("PRAGMA cache_size=-64000")
+        # wait for other threads to finish writing instead of failing
+        con.execute("PRAGMA busy_timeout=5000")
+        return con
+
+    def write_batch(self, con, writes):
+        """Write all of the buffered database updates in a single transaction"""
+        if not writes:
+            return
+        cur = con.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, data in writes:
+                cur.executemany(sql, data)
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+        cur.execute("COMMIT")
 
     def create_db(self):
         """Create a sqlite database to track files that have been uploaded"""
-        con = sqlite3.connect(self.args.db_name)
+        con = self.connect_db()
         cur = con.cursor()
+        cur.execute("BEGIN")
+        self.create_documents_table(cur)
+        self.create_error_table(cur)
+        self.create_indexes(cur)
+        cur.execute("COMMIT")
+        con.close()
+
+    def create_documents_table(self, cur, name="documents"):
+        """Create the table to track the upload status of each document"""
         cur.execute(
-            "CREATE TABLE documents"
+            f"CREATE TABLE {name}"
             "(document_number TEXT NOT NULL UNIQUE, uploaded INTEGER NOT NULL, "
-            "error INTEGER NOT NULL, error_msg TEXT NOT NULL)"
+            "error INTEGER NOT NULL)"
         )
-        con.commit()
+
+    def create_error_table(self, cur):
+        """
+        Create a table to store the error messages
+
+        Most documents never have an error, so the messages are kept out of the
+        documents table, which keeps it small.  There is a row for each failed
+        attempt to upload a document.
+        """
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS document_errors"
+            "(document_number TEXT NOT NULL, attempt INTEGER NOT NULL, "
+            "error_msg TEXT NOT NULL)"
+        )
+
+    def create_indexes(self, cur):
+        """
+        Create indexes on the documents and document_errors tables
+
+        document_number is already indexed by its UNIQUE constraint.  The partial
+        index only contains the document numbers which have not been uploaded,
+        so looking up the errors is answered from the index alone, without
+        scanning the whole table.
+        """
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_documents_not_uploaded "
+            "ON documents(document_number) WHERE uploaded = 0"
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_document_errors_number "
+            "ON document_errors(document_number)"
+        )
+
+    def migrate_db(self):
+        """Update a database created by an older version of this script"""
+        con = self.connect_db()
+        cur = con.cursor()
+        cur.execute("BEGIN")
+        self.create_error_table(cur)
+        columns = [row[1] for row in cur.execute("PRAGMA table_info(documents)")]
+        if "error_msg" in columns:
+            logger.info("Moving error messages to the document_errors table")
+            cur.execute(
+                "INSERT INTO document_errors "
+                "SELECT document_number, error, error_msg FROM documents "
+                "WHERE error_msg != ''"
+            )
+            if sqlite3.sqlite_version_info >= (3, 35):
+                cur.execute("ALTER TABLE documents DROP COLUMN error_msg")
+            else:
+                # older versions of sqlite can not drop a column, so copy the
+                # documents in to a new table without it
+                self.create_documents_table(cur, "documents_new")
+                cur.execute(
+                    "INSERT INTO documents_new(document_number, uploaded, error) "
+                    "SELECT document_number, uploaded, error FROM documents"
+                )
+                cur.execute("DROP TABLE documents")
+                cur.execute("ALTER TABLE documents_new RENAME TO documents")
+        self.create_indexes(cur)
+        cur.execute("COMMIT")
         con.close()
 
-    def get_documents_uploaded(self):
-        """Read in the document IDs for all documents already uploaded"""
-        print("Reading uploaded docs from db")
+    def log_errors(self, writes, error_data):
+        """
+        Add the database updates to record errors
+
+        error_data is a list of (document_number, error_msg) tuples.  This
+        increments the error count for each document, and then records the
+        message in document_errors under that attempt number.
+        """
+        writes.append(
+            (SQL_ERROR, [(document_number,) for document_number, _ in error_data])
+        )
+        writes.append(
+            (
+                SQL_ERROR_MSG,
+                [
+                    (error_msg, document_number)
+                    for document_number, error_msg in error_data
+                ],
+            )
+        )
+
+    def get_documents_uploaded(self, cur, document_numbers):
+        """
+        Get which of the given document numbers are already in the database
+
+        The document numbers are looked up in groups using the index on
+        document_number, so that we do not need to read every document number
+        in the database in to memory up front.
+        """
         uploaded_docs = set()
-        con = sqlite3.connect(self.args.db_name)
-        cur = con.cursor()
-        for row in cur.execute("SELECT document_number FROM documents"):
-            uploaded_docs.add(row[0])
-        print("Done reading uploaded docs from db", len(uploaded_docs))
+        for i in range(0, len(document_numbers), LOOKUP_SIZE):
+            group = document_numbers[i : i + LOOKUP_SIZE]
+            uploaded_docs.update(
+                row[0]
+                for row in cur.execute(
+                    "SELECT document_number FROM documents "
+                    f"WHERE document_number IN ({','.join('?' * len(group))})",
+                    group,
+                )
+            )
         return uploaded_docs
 
-    def get_new_files(self, uploaded_docs):
+    def get_new_files(self, cur):
         """Read files to upload from the CSV"""
+        if pyarrow is not None:
+            yield from self.get_new_files_arrow(cur)
+            return
         with open(self.args.csv, encoding="utf8") as metadata:
             reader = csv.reader(metadata)
-            self.headers = next(reader)
-            for row in reader:
-                if row[self.name_col_index()] not in uploaded_docs:
-                    yield row
+            self.set_headers(next(reader))
+            while rows := list(islice(reader, LOOKUP_SIZE)):
+                yield from self.filter_uploaded(cur, rows)
+
+    def filter_uploaded(self, cur, rows):
+        """Filter out the rows which have already been uploaded
 
-    def enqueue_files(self, queue, uploaded_docs, event):
+        Rows too short to have a document number are kept, so that they are
+        reported when they are taken off the queue
+        """
+        name_col_index = self.name_col_index()
+        uploaded_docs = self.get_documents_uploaded(
+            cur, [row[name_col_index] for row in rows if len(row) > name_col_index]
+        )
+        for row in rows:
+            if len(row) <= name_col_index or row[name_col_index] not in uploaded_docs:
+                yield row
+
+    def get_new_files_arrow(self, cur):
+        """
+        Read files to upload from the CSV using pyarrow
+
+        pyarrow parses the CSV natively, and lets us filter out the files which
+        have already been uploaded for a whole batch of rows at once, instead of
+        checking each row in Python.  The CSV is streamed a block at a time, so
+        uploads can start before the whole file has been parsed.
+
+        pyarrow rejects rows with a different number of columns than the
+        headers, which the csv module accepts, so those rows are set aside and
+        parsed with the csv module instead.
+        """
+        with open(self.args.csv, encoding="utf8") as metadata:
+            self.set_headers(next(csv.reader(metadata)))
+        invalid_rows = []
+
+        def invalid_row_handler(row):
+            invalid_rows.append(row.text)
+            return "skip"
+
+        def parse_invalid_rows():
+            # the handler may be called while reading ahead in another thread,
+            # so only remove the rows which have been parsed
+            count = len(invalid_rows)
+            rows = [
+                next(csv.reader(io.StringIO(text, newline=None)))
+                for text in invalid_rows[:count]
+            ]
+            del invalid_rows[:count]
+            return self.filter_uploaded(cur, rows)
+
+        reader = pyarrow.csv.open_csv(
+            self.args.csv,
+            read_options=pyarrow.csv.ReadOptions(
+                use_threads=True, block_size=CSV_BLOCK_SIZE
+            ),
+            parse_options=pyarrow.csv.ParseOptions(
+                newlines_in_values=True, invalid_row_handler=invalid_row_handler
+            ),
+            # keep all values as strings, the same as the csv module
+            convert_options=pyarrow.csv.ConvertOptions(
+                column_types={header: pyarrow.string() for header in self.headers}
+            ),
+        )
+        for batch in reader:
+            document_numbers = batch.column(self.name_col_index())
+            uploaded_docs = self.get_documents_uploaded(
+                cur, document_numbers.to_pylist()
+            )
+            mask = pyarrow.compute.invert(
+                pyarrow.compute.is_in(
+                    document_numbers,
+                    value_set=pyarrow.array(list(uploaded_docs), type=pyarrow.string()),
+                )
+            )
+            yield from zip(
+                *(column.to_pylist() for column in batch.filter(mask).columns)
+            )
+            yield from parse_invalid_rows()
+        yield from parse_invalid_rows()
+
+    def enqueue_files(self, queue, event):
         """Add files to the queue as room becomes available"""
-        print("queuing files")
-        for i, row in enumerate(self.get_new_files(uploaded_docs)):
-            if i % 1000 == 0:
-                print(f"queueing file #{i}")
-            queue.put(row)
-            if self.args.max is not None and i >= (self.args.max - 1):
-                break
-            if event.is_set():
-                break
-        print("done queuing")
-        queue.put(SENTINEL)
+        logger.info("queuing files")
+        con = self.connect_db()
+        try:
+            for i, row in enumerate(self.get_new_files(con.cursor())):
+                if i % 1000 == 0:
+                    logger.info("queueing file #%d", i)
+                queue.put(row)
+                if self.args.max is not None and i >= (self.args.max - 1):
+                    break
+                if event.is_set():
+                    break
+        finally:
+            con.close()
+            # always let the upload threads know there are no more files, even
+            # if reading the CSV failed, so that they do not wait forever
+            queue.put(SENTINEL)
+        logger.info("done queuing")
 
     def row_to_dict(self, row):
         """
@@ -91,84 +399,188 @@ class BatchUploader:
         Sets the rest of the CSV columns as metadata
         """
 
-        doc_dict = dict(zip(self.headers, row))
-        title = doc_dict.pop("title")
+        # rows may be shorter than the headers, in which case the missing
+        # columns are left out
+        length = len(row)
         return {
-            "title": title,
+            "title": row[self.title_index] if self.title_index < length else "",
             "projects": [self.args.project_id],
             "source": self.args.source,
             "access": self.args.access,
             "delayed_index": True,
-            "data": doc_dict,
+            "data": {
+                header: row[i] for i, header in self.metadata_columns if i < length
+            },
         }
 
-    def get_files_from_queue(self, queue):
+    def get_rows_from_queue(self, queue, event):
+        """
+        Get a batch of rows from the queue
+
+        Waits until a full batch is available, or the sentinel has been queued,
+        and then takes the whole batch while only acquiring the queue's lock once,
+        instead of once per row.  The sentinel is included as the last row if it
+        was reached.  Returns an empty list if the event is set while waiting.
+        """
+
+        def batch_ready():
+            return len(queue.queue) >= self.args.batch_size or (
+                queue.queue and queue.queue[-1] is SENTINEL
+            )
+
+        rows = []
+        with queue.not_empty:
+            # wake up periodically to check if we have been asked to stop
+            while not queue.not_empty.wait_for(batch_ready, timeout=QUEUE_TIMEOUT):
+                if event.is_set():
+                    return []
+            while queue.queue and len(rows) < self.args.batch_size:
+                rows.append(queue.queue.popleft())
+                if rows[-1] is SENTINEL:
+                    break
+            # wake up the producer, as there is now room in the queue
+            queue.not_full.notify(len(rows))
+        return rows
+
+    def get_files_from_queue(self, queue, event):
         """Get files from the queue and convert them into a format suitable for upload
         Also check if we are out of files to upload
         """
-        doc_dicts = []
-        finished = False
-        for _ in range(self.args.batch_size):
-            row = queue.get()
-            if row is SENTINEL:
-                finished = True
-                break
-            doc_dict = self.row_to_dict(row)
-            doc_dicts.append(doc_dict)
-        print(current_thread().name, [d["data"][self.args.name_col] for d in doc_dicts])
+        rows = self.get_rows_from_queue(queue, event)
+        finished = not rows or rows[-1] is SENTINEL
+        if rows and finished:
+            rows.pop()
+        # without a document number a row can not be uploaded or tracked
+        name_col_index = self.name_col_index()
+        short_rows = [row for row in rows if len(row) <= name_col_index]
+        if short_rows:
+            logger.warning("skipping rows without a document number %s", short_rows)
+            rows = [row for row in rows if len(row) > name_col_index]
+        doc_dicts = [self.row_to_dict(row) for row in rows]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug([d["data"][self.args.name_col] for d in doc_dicts])
         return doc_dicts, finished
 
-    def create_documents(self, client, doc_dicts, con, cur):
+    def get_pdf_path(self, doc_dict):
+        """Get the path to the PDF file for a document"""
+        return os.path.join(self.args.path, doc_dict["data"][self.args.name_col])
+
+    def check_files(self, doc_dicts, writes):
+        """
+        Check that the files exist and are not empty before creating the documents
+
+        Files which are missing or empty are logged as errors and removed from
+        the batch, so that we do not create documents for them on DocumentCloud
+        which would then need to be deleted.
+
+        Returns the remaining documents, and the paths and sizes of their files,
+        which are needed when uploading them.
+        """
+        checked_doc_dicts = []
+        files = []
+        error_data = []
+        for doc_dict in doc_dicts:
+            pdf_path = self.get_pdf_path(doc_dict)
+            try:
+                size = os.path.getsize(pdf_path)
+            except OSError as exc:
+                error_data.append((doc_dict["data"][self.args.name_col], str(exc)))
+                continue
+            if size == 0:
+                error_data.append((doc_dict["data"][self.args.name_col], "empty file"))
+                continue
+            checked_doc_dicts.append(doc_dict)
+            files.append((pdf_path, size))
+        if error_data:
+            logger.warning("check files error %s", error_data)
+            self.log_errors(writes, error_data)
+        return checked_doc_dicts, files
+
+    def create_documents(self, client, doc_dicts, writes):
         """Create the documents on DocumentCloud"""
         # Upload all the pdfs using the bulk API to reduce the number
         # of API calls and improve performance
         try:
-            print(current_thread().name, "create documents")
+            logger.debug("create documents")
             response = client.post("documents/", json=doc_dicts)
             response.raise_for_status()
         except (APIError, RequestException) as exc:
-            print("create documents exception", str(exc))
-            data = [(d["data"][self.args.name_col], 0, 1, str(exc)) for d in doc_dicts]
-            print(data)
-            cur.executemany(
-                "INSERT INTO documents VALUES(?, ?, ? ,?) "
-                "ON CONFLICT (document_number) DO "
-                "UPDATE SET error=error+1, error_msg=excluded.error_msg",
-                data,
-            )
-            con.commit()
+            logger.warning("create documents exception %s", exc)
+            data = [(d["data"][self.args.name_col], str(exc)) for d in doc_dicts]
+            logger.debug(data)
+            self.log_errors(writes, data)
             raise
         for resp, doc_dict in zip(response.json(), doc_dicts):
             doc_dict["id"] = resp["id"]
             doc_dict["presigned_url"] = resp["presigned_url"]
 
-    def upload_files_s3(self, doc_dicts, client, con, cur):
+    async def create_session(self):
+        """Create an aiohttp session for uploading to S3"""
+        return aiohttp.ClientSession(
+            # only MAX_CONCURRENT_PUTS uploads run at once, so that is the most
+            # connections which will be kept alive between batches
+            connector=aiohttp.TCPConnector(
+                limit=MAX_CONCURRENT_PUTS, keepalive_timeout=120, ttl_dns_cache=600
+            ),
+            timeout=S3_TIMEOUT,
+        )
+
+    def get_session(self):
+        """
+        Get the event loop and aiohttp session for the current thread
+
+        These are kept for the lifetime of the thread, so that connections to S3
+        are kept alive and re-used across batches, instead of setting up a new
+        event loop and re-doing the TLS handshakes for every batch.
+        """
+        if getattr(self.local, "session", None) is None:
+            self.local.loop = asyncio.new_event_loop()
+            self.local.session = self.local.loop.run_until_complete(
+                self.create_session()
+            )
+        return self.local.loop, self.local.session
+
+    def close_session(self):
+        """Close the event loop and aiohttp session for the current thread"""
+        if getattr(self.local, "session", None) is None:
+            return
+        self.local.loop.run_until_complete(self.local.session.close())
+        self.local.loop.close()
+        self.local.loop = None
+        self.local.session = None
+
+    async def read_chunks(self, pdf_path):
+        """Read a file in chunks, so that it can be streamed to S3 without
+        loading the entire file in to memory
+        """
+        async with aiofiles.open(pdf_path, "rb") as pdf_file:
+            while chunk := await pdf_file.read(CHUNK_SIZE):
+                yield chunk
+
+    def upload_files_s3(self, doc_dicts, files, client, writes):
         """Directly upload all of the files to S3"""
         presigned_urls = [d["presigned_url"] for d in doc_dicts]
 
-        async def do_puts():
+        async def do_put(session, semaphore, url, pdf_path, size):
+            async with semaphore:
+                # S3 does not accept chunked uploads, so the content length
+                # must be set explicitly when streaming the file
+                async with session.put(
+                    url,
+                    data=self.read_chunks(pdf_path),
+                    headers={"Content-Length": str(size)},
+                ) as response:
+                    return response
+
+        async def do_puts(session):
             tasks = []
-            async with aiohttp.ClientSession() as session:
-                for url, doc_dict in zip(presigned_urls, doc_dicts):
-                    pdf_path = os.path.join(
-                        self.args.path,
-                        doc_dict["data"][self.args.name_col],
-                    )
-                    print(
-                        current_thread().name,
-                        "uploading",
-                        pdf_path,
-                        os.path.getsize(pdf_path),
-                    )
-                    with open(pdf_path, "rb") as pdf_file:
-                        tasks.append(session.put(url, data=pdf_file.read()))
-                return await asyncio.gather(*tasks, return_exceptions=True)
-
-        responses = asyncio.run(do_puts())
-        print(
-            "upload response errors",
-            [repr(r) for r in responses if isinstance(r, Exception)],
-        )
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_PUTS)
+            for url, (pdf_path, size) in zip(presigned_urls, files):
+                tasks.append(do_put(session, semaphore, url, pdf_path, size))
+            return await asyncio.gather(*tasks, return_exceptions=True)
+
+        loop, session = self.get_session()
+        responses = loop.run_until_complete(do_puts(session))
         # get IDs to pass along to process
         process_json = [
             str(d["id"])
@@ -177,19 +589,13 @@ class BatchUploader:
         ]
         # get document numbers of errored documents to mark in db
         error_data = [
-            (d["data"][self.args.name_col], 0, 1, str(resp))
+            (d["data"][self.args.name_col], str(resp))
             for resp, d in zip(responses, doc_dicts)
             if isinstance(resp, Exception)
         ]
         if error_data:
-            print("upload files error", error_data)
-            cur.executemany(
-                "INSERT INTO documents VALUES(?, ?, ? ,?) "
-                "ON CONFLICT (document_number) DO "
-                "UPDATE SET error=error+1, error_msg=excluded.error_msg",
-                error_data,
-            )
-            con.commit()
+            logger.warning("upload files error %s", error_data)
+            self.log_errors(writes, error_data)
         # get error IDs to delete from DocumentCloud
         error_ids = [
             str(d["id"])
@@ -200,107 +606,202 @@ class BatchUploader:
             try:
                 client.delete("documents/", params={"id__in": ",".join(error_ids)})
             except (APIError, RequestException) as exc:
-                print(f"Error deleting: {exc}")
+                logger.warning("Error deleting: %s", exc)
         return process_json
 
-    def process_documents(self, client, doc_ids, doc_dicts, con, cur):
+    def process_documents(self, client, doc_ids, doc_dicts, writes):
         """Beging processing the documents after the files have been uploaded"""
         # begin processing the documents
         if not doc_ids:
             return
+        # use a set to check which documents are being processed
+        doc_id_set = set(doc_ids)
         try:
-            print(current_thread().name, "processing")
+            logger.debug("processing")
             response = client.post("documents/process/", json={"ids": doc_ids})
             response.raise_for_status()
         except (APIError, RequestException) as exc:
             # log all as errors in the db
-            print("process error", str(exc))
+            logger.warning("process error %s", exc)
             data = [
-                (d["data"][self.args.name_col], 0, 1, str(exc))
+                (d["data"][self.args.name_col], str(exc))
                 for d in doc_dicts
-                if str(d["id"]) in doc_ids
+                if str(d["id"]) in doc_id_set
             ]
-            print(data)
-            cur.executemany(
-                "INSERT INTO documents VALUES(?, ?, ? ,?) "
-                "ON CONFLICT (document_number) DO "
-                "UPDATE SET error=error+1, error_msg=excluded.error_msg",
-                data,
-            )
-            con.commit()
+            logger.debug(data)
+            self.log_errors(writes, data)
             # try to delete all of these documents
             try:
                 client.delete("documents/", params={"id__in": ",".join(doc_ids)})
             except (APIError, RequestException) as exc_:
-                print(f"Error deleting: {exc_}")
+                logger.warning("Error deleting: %s", exc_)
             raise
 
         data = [
-            (d["data"][self.args.name_col], 1, 0, "")
+            (d["data"][self.args.name_col],)
             for d in doc_dicts
-            if str(d["id"]) in doc_ids
+            if str(d["id"]) in doc_id_set
         ]
-        print("process success", data)
-        cur.executemany(
-            "INSERT INTO documents VALUES(?, ?, ? ,?) "
-            "ON CONFLICT (document_number) DO "
-            "UPDATE SET uploaded=excluded.uploaded",
-            data,
-        )
-        con.commit()
+        logger.debug("process success %s", data)
+        writes.append((SQL_UPLOADED, data))
 
-    def drain_queue(self, queue):
-        """Empty the queue"""
+    def process_batch(self, client, doc_ids, doc_dicts):
+        """
+        Process a batch of documents in the background
+
+        Returns the database updates to make, which are written out by the
+        upload thread along with the rest of its updates.
+        """
+        writes = []
         try:
-            while True:
-                queue.get(block=False)
-        except Empty:
+            self.process_documents(client, doc_ids, doc_dicts, writes)
+        except (APIError, RequestException):
+            # the errors have already been logged
             pass
+        except Exception as exc:
+            # exception catch all
+            logger.exception("Unknown exception")
+            data = [(d["data"][self.args.name_col], str(exc)) for d in doc_dicts]
+            logger.debug(data)
+            self.log_errors(writes, data)
+        return writes
+
+    def wait_for_processing(self, processing):
+        """Wait for a batch being processed in the background to finish, and
+        return its database updates
+        """
+        if processing is None:
+            return []
+        return processing.result()
+
+    def drain_queue(self, queue):
+        """Empty the queue"""
+        with queue.mutex:
+            queue.queue.clear()
+            # wake up the producer if it is waiting for room in the queue
+            queue.not_full.notify_all()
 
     def upload_files_dc(self, queue, client, event):
         """Uploads files to DocumentCloud"""
-        con = sqlite3.connect(self.args.db_name)
-        cur = con.cursor()
-        while True:
-            try:
-                doc_dicts, finished = self.get_files_from_queue(queue)
-                if not doc_dicts:
-                    queue.put(SENTINEL)
-                    print(current_thread().name, "done")
-                    return
+        con = self.connect_db()
+        # buffer the successful uploads across batches, so that the write lock
+        # is only taken once every WRITE_BUFFER_SIZE rows or WRITE_BUFFER_TIME
+        # seconds instead of every batch
+        writes = []
+        last_write = time.monotonic()
+        # each batch is processed in the background, while the next batch is
+        # being created and uploaded to S3, to hide the latency of the process
+        # API call
+        process_executor = ThreadPoolExecutor(max_workers=1)
+        processing = None
+        try:
+            while True:
+                # reset the batch, so that an error is never reported against
+                # the previous batch
+                doc_dicts, finished = [], False
+                try:
+                    doc_dicts, finished = self.get_files_from_queue(queue, event)
+                    if finished and not doc_dicts:
+                        # the sentinel or a shutdown was reached with nothing
+                        # left to upload, so skip straight to stopping
+                        break
+
+                    doc_dicts, files = self.check_files(doc_dicts, writes)
+                    if doc_dicts:
+                        self.create_documents(client, doc_dicts, writes)
+                        process_json = self.upload_files_s3(
+                            doc_dicts, files, client, writes
+                        )
+                        # only process one batch at a time, so wait for the
+                        # previous batch before processing this one
+                        writes.extend(self.wait_for_processing(processing))
+                        processing = process_executor.submit(
+                            self.process_batch, client, process_json, doc_dicts
+                        )
 
-                self.create_documents(client, doc_dicts, con, cur)
-                process_json = self.upload_files_s3(doc_dicts, client, con, cur)
-                self.process_documents(client, process_json, doc_dicts, con, cur)
+                except (APIError, RequestException) as exc:
+                    # if there is an error, first check if we are finished,
+                    # then continue on to the next batch
+                    pass
+                except Exception as exc:
+                    # exception catch all
+                    logger.exception("Unknown exception")
+                    data = [
+                        (d["data"][self.args.name_col], str(exc)) for d in doc_dicts
+                    ]
+                    logger.debug(data)
+                    self.log_errors(writes, data)
+
+                # errors are written out straight away, so that they are not
+                # lost if the script is stopped abruptly
+                if writes and (
+                    any(sql == SQL_ERROR for sql, _ in writes)
+                    or sum(len(data) for _, data in writes) >= WRITE_BUFFER_SIZE
+                    or time.monotonic() - last_write >= WRITE_BUFFER_TIME
+                ):
+                    self.write_batch(con, writes)
+                    writes = []
+                    last_write = time.monotonic()
+
+                if finished or event.is_set():
+                    break
 
-            except (APIError, RequestException) as exc:
-                # if there is an error, first check if we are finished,
-                # then continue on to the next batch
-                pass
-            except Exception as exc:
-                # exception catch all
-                print("Unknown exception")
-                data = [
-                    (d["data"][self.args.name_col], 0, 1, str(exc)) for d in doc_dicts
-                ]
-                print(data)
-                cur.executemany(
-                    "INSERT INTO documents VALUES(?, ?, ? ,?) "
-                    "ON CONFLICT (document_number) DO "
-                    "UPDATE SET error=error+1, error_msg=excluded.error_msg",
-                    data,
-                )
-                con.commit()
+            if event.is_set():
+                self.drain_queue(queue)
+            else:
+                # put the sentinel back on the queue for the other threads to receive it
+                queue.put(SENTINEL)
+            logger.info("done")
+        finally:
+            # write out anything left in the buffer and clean up, however the
+            # thread exits
+            writes.extend(self.wait_for_processing(processing))
+            process_executor.shutdown()
+            self.write_batch(con, writes)
+            con.close()
+            self.close_session()
+
+    def create_client(self):
+        """
+        Create the DocumentCloud client
 
-            if finished or event.is_set():
-                con.close()
-                if event.is_set():
-                    self.drain_queue(queue)
-                else:
-                    # put the sentinel back on the queue for the other threads to receive it
-                    queue.put(SENTINEL)
-                print(current_thread().name, "done")
-                return
+        The client is shared between all of the threads, so its connection pool
+        is made large enough to keep a connection alive for each of them instead
+        of reconnecting for each API call.  Idempotent requests are retried if
+        the API is temporarily unavailable.
+        """
+        client = documentcloud.DocumentCloud(
+            username=os.environ["DC_USERNAME"], password=os.environ["DC_PASSWORD"]
+        )
+        # the most threads which use the client at once are the SEARCH_WORKERS
+        # searching for error files - uploading uses at most 8, as there are at
+        # most 4 upload threads, each with one background processing thread
+        client.session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_maxsize=SEARCH_WORKERS,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=0.5,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    # do not raise an exception once the retries are exhausted,
+                    # so that the response status is handled as before
+                    raise_on_status=False,
+                ),
+            ),
+        )
+        # the client mounts a new default adapter on its session before every
+        # request, which would replace this one, and its open connections, so
+        # only let it set up the other sessions it uses to log in
+        default_retry_session = client.requests_retry_session
+
+        def requests_retry_session(session=None, **kwargs):
+            if session is client.session:
+                return session
+            return default_retry_session(session=session, **kwargs)
+
+        client.requests_retry_session = requests_retry_session
+        return client
 
     def delete_proj(self, proj):
         """
@@ -309,9 +810,7 @@ class BatchUploader:
         You can use this if you start the upload and something goes wrong early on,
         and it'll be easier to just start over.
         """
-        client = documentcloud.DocumentCloud(
-            username=os.environ["DC_USERNAME"], password=os.environ["DC_PASSWORD"]
-        )
+        client = self.create_client()
         for group in grouper(client.documents.search(f"project:{proj}"), 25):
             ids = [str(d.id) for d in group if d]
             # print(ids)
@@ -321,197 +820,333 @@ class BatchUploader:
 
     def get_error_files(self):
         """Get files which had an error uploading from the database"""
-        con = sqlite3.connect(self.args.db_name)
+        con = self.connect_db()
         cur = con.cursor()
-        print(
-            list(cur.execute("SELECT COUNT(*) FROM documents WHERE uploaded = 0"))[0][0]
-        )
-        return [
+        error_files = [
             r[0]
             for r in cur.execute(
                 "SELECT document_number FROM documents WHERE uploaded = 0"
             )
         ]
+        con.close()
+        logger.debug("%d files with errors", len(error_files))
+        return error_files
+
+    def search_term(self, document_number):
+        """Quote a document number to be searched for"""
+        return '"{}"'.format(document_number.replace("\\", "\\\\").replace('"', '\\"'))
+
+    def search_groups(self, document_numbers):
+        """
+        Split the document numbers in to groups to search for together
+
+        Each group is limited to SEARCH_SIZE document numbers, and to a query of
+        about SEARCH_QUERY_SIZE characters once it is URL encoded, as the query
+        is sent in the URL
+        """
+        group = []
+        size = 0
+        for document_number in document_numbers:
+            # include the length of the separating " OR "
+            term_size = len(quote_plus(self.search_term(document_number))) + 4
+            if group and (
+                len(group) >= SEARCH_SIZE or size + term_size > SEARCH_QUERY_SIZE
+            ):
+                yield group
+                group = []
+                size = 0
+            group.append(document_number)
+            size += term_size
+        if group:
+            yield group
+
+    def search_documents(self, client, document_numbers, project_id=None):
+        """
+        Search for the documents with any of the given document numbers,
+        optionally only within the given project
+
+        Returns the results for each document number, so that many documents
+        can be looked up with a single search
+        """
+        values = " OR ".join(self.search_term(d) for d in document_numbers)
+        query = f"+data_{self.args.name_col}:({values})"
+        if project_id is not None:
+            query = f"+project:{project_id} {query}"
+        found = {d: [] for d in document_numbers}
+        for result in client.documents.search(query):
+            document_number = result.data[self.args.name_col][0]
+            if document_number in found:
+                found[document_number].append(result)
+        return found
+
+    def delete_documents(self, client, ids):
+        """
+        Delete the documents with the given IDs, DELETE_SIZE at a time
+
+        Falls back to deleting the documents individually if a bulk delete fails.
+        Returns the IDs of the documents which could not be deleted.
+        """
+        failed = set()
+        for group in grouper(ids, DELETE_SIZE):
+            group = [i for i in group if i is not None]
+            try:
+                resp = client.delete(
+                    "documents/", params={"id__in": ",".join(str(i) for i in group)}
+                )
+                resp.raise_for_status()
+            except (APIError, RequestException):
+                logger.warning("error bulk deleting, deleting individually")
+                for id_ in group:
+                    try:
+                        resp = client.delete(f"documents/{id_}/")
+                        resp.raise_for_status()
+                    except (APIError, RequestException) as exc:
+                        logger.warning("error deleting %s, %s", id_, exc)
+                        failed.add(id_)
+        return failed
 
     def reupload_error_files(self):
         """
         Re-upload error files
         Files with errors during upload (error in sqlite db)
         """
-        client = documentcloud.DocumentCloud(
-            username=os.environ["DC_USERNAME"], password=os.environ["DC_PASSWORD"]
-        )
-        con = sqlite3.connect(self.args.db_name)
+        client = self.create_client()
+        con = self.connect_db()
         cur = con.cursor()
 
         reupload = []
 
-        for document_number in self.get_error_files():
-            print("document_number", document_number)
-            results = list(
-                client.documents.search(
-                    "*:*", **{f"data_{self.args.name_col}": document_number}
-                )
-            )
-
-            if len(results) == 0:
-                print("count 0, reupload")
-                reupload.append(document_number)
-            elif len(results) == 1:
-                print("count 1")
-                result = results[0]
-                if result.status == "success":
-                    print("success, set upload true")
-                    cur.execute(
-                        "UPDATE documents SET uploaded = 1 WHERE document_number = ?",
-                        (document_number,),
+        def search(group):
+            try:
+                return group, self.search_documents(client, group)
+            except (APIError, RequestException) as exc:
+                logger.warning("error searching %s", exc)
+                return group, None
+
+        error_files = self.get_error_files()
+        # search for a whole group of document numbers at once, and run the
+        # searches in parallel, as each one is a round trip to the API
+        with ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as executor:
+            for group, found in executor.map(search, self.search_groups(error_files)):
+                if found is None:
+                    cur.executemany(
+                        SQL_INCREMENT_ERROR,
+                        [(document_number,) for document_number in group],
                     )
-                else:
-                    print("delete and reupload")
-                    try:
-                        resp = client.delete(f"documents/{result.id}/")
-                        resp.raise_for_status()
-                    except (APIError, RequestException) as exc:
-                        print(f"error deletiing {result.id}, {exc}")
-                        cur.execute(
-                            "UPDATE documents SET error = error + 1 WHERE document_number = ?",
-                            (document_number,),
-                        )
-                    else:
-                        print("reuploading")
+                    continue
+                # decide what to delete for the whole group first, so that the
+                # deletes can be done in bulk
+                deletes = {}
+                for document_number, results in found.items():
+                    logger.info("document_number %s", document_number)
+
+                    if len(results) == 0:
+                        logger.info("count 0, reupload")
                         reupload.append(document_number)
-            else:
-                print("count more than 1")
-                if any(r.status == "success" for r in results):
-                    print("at least one success")
-                    first_success = [r for r in results if r.status == "success"][0]
-                    for result in results:
-                        if result == first_success:
-                            continue
-                        try:
-                            resp = client.delete(f"documents/{result.id}/")
-                            resp.raise_for_status()
-                        except (APIError, RequestException):
-                            print("error deleting")
-                            cur.execute(
-                                "UPDATE documents SET error = error + 1 WHERE document_number = ?",
-                                (document_number,),
-                            )
-                            break
+                    elif len(results) == 1:
+                        logger.info("count 1")
+                        result = results[0]
+                        if result.status == "success":
+                            logger.info("success, set upload true")
+                            cur.execute(SQL_SET_UPLOADED, (document_number,))
+                        else:
+                            logger.info("delete and reupload")
+                            deletes[document_number] = (results, True)
                     else:
-                        print("deleted successfully, setting upload")
-                        cur.execute(
-                            "UPDATE documents SET uploaded = 1 WHERE document_number = ?",
-                            (document_number,),
-                        )
-                else:
-                    for result in results:
-                        try:
-                            resp = client.delete(f"documents/{result.id}/")
-                            resp.raise_for_status()
-                        except (APIError, RequestException):
-                            cur.execute(
-                                "UPDATE documents SET error = error + 1 WHERE document_number = ?",
-                                (document_number,),
+                        logger.info("count more than 1")
+                        if any(r.status == "success" for r in results):
+                            logger.info("at least one success")
+                            first_success = [
+                                r for r in results if r.status == "success"
+                            ][0]
+                            deletes[document_number] = (
+                                [r for r in results if r != first_success],
+                                False,
                             )
-                            break
-                    else:
-                        print("deleted successfully, reuploading")
+                        else:
+                            deletes[document_number] = (results, True)
+
+                failed = self.delete_documents(
+                    client,
+                    [r.id for results, _ in deletes.values() for r in results],
+                )
+                for document_number, (results, is_reupload) in deletes.items():
+                    if any(r.id in failed for r in results):
+                        cur.execute(SQL_INCREMENT_ERROR, (document_number,))
+                    elif is_reupload:
+                        logger.info("deleted successfully, reuploading")
                         reupload.append(document_number)
+                    else:
+                        logger.info("deleted successfully, setting upload")
+                        cur.execute(SQL_SET_UPLOADED, (document_number,))
 
-            if len(reupload) == self.args.batch_size:
-                print("reuploading a batch")
-                self.reupload_files(client, con, cur, reupload)
-                reupload = []
+                while len(reupload) >= self.args.batch_size:
+                    logger.info("reuploading a batch")
+                    self.reupload_files(client, con, reupload[: self.args.batch_size])
+                    reupload = reupload[self.args.batch_size :]
 
         # reupload the stragglers
         if reupload:
-            self.reupload_files(client, con, cur, reupload)
+            self.reupload_files(client, con, reupload)
+        self.close_session()
 
     def reupload_error_files2(self):
         """
         Re-upload error files
         Files with errors during processing (error on DC)
         """
-        client = documentcloud.DocumentCloud(
-            username=os.environ["DC_USERNAME"], password=os.environ["DC_PASSWORD"]
-        )
-        con = sqlite3.connect(self.args.db_name)
+        client = self.create_client()
+        con = self.connect_db()
         cur = con.cursor()
 
-        reupload = []
-
         errors = client.documents.search(
             f"+project:{self.args.project_id} +status:(nofile OR error)"
         )
-        print(errors.count)
+        logger.info("%d documents with errors", errors.count)
+
+        for group in grouper(errors, self.args.batch_size):
+            results = [r for r in group if r]
+            document_numbers = [r.data[self.args.name_col][0] for r in results]
+            logger.info("document_numbers %s", document_numbers)
+
+            logger.info("delete and reupload")
+            failed = self.delete_documents(client, [r.id for r in results])
+            reupload = []
+            for result, document_number in zip(results, document_numbers):
+                if result.id in failed:
+                    cur.execute(SQL_INCREMENT_ERROR, (document_number,))
+                else:
+                    reupload.append(document_number)
 
-        for result in errors:
-            document_number = result.data[self.args.name_col][0]
-            print("document_number", document_number)
+            if reupload:
+                logger.info("reuploading a batch")
+                self.reupload_files(client, con, reupload)
+        self.close_session()
 
-            print("delete and reupload")
-            try:
-                resp = client.delete(f"documents/{result.id}/")
-                resp.raise_for_status()
-            except (APIError, RequestException):
-                print("error deletiing")
-                cur.execute(
-                    "UPDATE documents SET error = error + 1 WHERE document_number = ?",
-                    (document_number,),
-                )
-            else:
-                print("reuploading")
-                reupload.append(document_number)
+    def load_csv_index(self):
+        """
+        Index the CSV rows by document number
 
-            if len(reupload) == self.args.batch_size:
-                print("reuploading a batch")
-                self.reupload_files(client, con, cur, reupload)
-                reupload = []
+        Each document number maps to a list of its rows, so a document number
+        which appears more than once returns all of its rows, the same as
+        scanning the file does.  The index is built once and reused for every
+        re-upload batch, so we do not re-parse the entire CSV for each batch.
+        It is rebuilt if the CSV has been modified since it was last read.
+        """
+        mtime = os.stat(self.args.csv).st_mtime_ns
+        if self.csv_index is None or mtime != self.csv_index_mtime:
+            logger.info("Indexing CSV")
+            with open(self.args.csv, encoding="utf8") as metadata:
+                reader = csv.reader(metadata)
+                self.set_headers(next(reader))
+                name_col_index = self.name_col_index()
+                self.csv_index = {}
+                for row in reader:
+                    if len(row) > name_col_index:
+                        self.csv_index.setdefault(row[name_col_index], []).append(row)
+            self.csv_index_mtime = mtime
+            logger.info("Done indexing CSV %d", len(self.csv_index))
+        return self.csv_index
+
+    def scan_csv_rows(self, document_numbers):
+        """
+        Find the CSV rows for the given document_numbers by searching the raw
+        bytes of the file, instead of parsing every row
 
-        # reupload the stragglers
-        if reupload:
-            self.reupload_files(client, con, cur, reupload)
+        Only the rows which contain one of the document numbers are parsed.  The
+        number of quotes before each match is counted, to find where its row
+        starts and ends when the row has quoted values which contain newlines.
+        """
+        with open(self.args.csv, encoding="utf8") as metadata:
+            self.set_headers(next(csv.reader(metadata)))
+        name_col_index = self.name_col_index()
+        document_numbers = set(document_numbers)
+        if not document_numbers:
+            return []
+        # a plain alternation of literals lets the regex engine search quickly,
+        # matches are checked against the parsed row below
+        pattern = re.compile(
+            b"|".join(re.escape(d.encode("utf8")) for d in document_numbers)
+        )
 
-    def get_rows_from_document_numbers(self, document_numbers):
-        """Get the metadata from the CSV given document_numbers"""
         rows = []
-        with open(self.args.csv, encoding="utf8") as metadata:
-            reader = csv.reader(metadata)
-            self.headers = next(reader)
-            for row in reader:
-                if row[self.name_col_index()] in document_numbers:
+        with open(self.args.csv, "rb") as metadata, mmap.mmap(
+            metadata.fileno(), 0, access=mmap.ACCESS_READ
+        ) as csv_map:
+            pos = 0
+            # the number of quotes in the file before `counted`
+            quotes = 0
+            counted = 0
+            while match := pattern.search(csv_map, pos):
+                start = csv_map.rfind(b"\n", 0, match.start()) + 1
+                end = csv_map.find(b"\n", match.end())
+                if end == -1:
+                    end = len(csv_map)
+                quotes += csv_map[counted:start].count(b'"')
+                counted = start
+                # a line which starts inside a quoted value is part of the row
+                # on an earlier line, so walk back to the start of that row
+                before = quotes
+                while before % 2:
+                    line_start = csv_map.rfind(b"\n", 0, start - 1) + 1
+                    before -= csv_map[line_start:start].count(b'"')
+                    start = line_start
+                # extend the row over any newlines inside quoted values
+                row_quotes = csv_map[start:end].count(b'"')
+                while row_quotes % 2 and end < len(csv_map):
+                    next_end = csv_map.find(b"\n", end + 1)
+                    if next_end == -1:
+                        next_end = len(csv_map)
+                    row_quotes += csv_map[end:next_end].count(b'"')
+                    end = next_end
+                pos = end + 1
+                # translate the newlines the same way as reading the file in text
+                # mode does for the index
+                text = csv_map[start:end].decode("utf8")
+                row = next(csv.reader(io.StringIO(text, newline=None)))
+                if (
+                    len(row) > name_col_index
+                    and row[name_col_index] in document_numbers
+                ):
                     rows.append(row)
         return rows
 
-    def reupload_files(self, client, con, cur, document_numbers):
+    def get_rows_from_document_numbers(self, document_numbers):
+        """Get the metadata from the CSV given document_numbers"""
+        if self.csv_index is None and not self.csv_scanned:
+            # for a single batch it is cheaper to search the file than to index
+            # it, so only build the index once a second batch is looked up
+            self.csv_scanned = True
+            return self.scan_csv_rows(document_numbers)
+        csv_index = self.load_csv_index()
+        return [row for d in document_numbers for row in csv_index.get(d, [])]
+
+    def reupload_files(self, client, con, document_numbers):
         """Re-upload a file which failed"""
         rows = self.get_rows_from_document_numbers(document_numbers)
         doc_dicts = [self.row_to_dict(row) for row in rows]
+        writes = []
+        doc_dicts, files = self.check_files(doc_dicts, writes)
         if not doc_dicts:
-            print("no docs!")
+            logger.info("no docs!")
+            self.write_batch(con, writes)
             return
 
         try:
-            self.create_documents(client, doc_dicts, con, cur)
-            process_json = self.upload_files_s3(doc_dicts, client, con, cur)
-            self.process_documents(client, process_json, doc_dicts, con, cur)
+            self.create_documents(client, doc_dicts, writes)
+            process_json = self.upload_files_s3(doc_dicts, files, client, writes)
+            self.process_documents(client, process_json, doc_dicts, writes)
         except (APIError, RequestException) as exc:
             # if there is an error, first check if we are finished,
             # then continue on to the next batch
             pass
         except Exception as exc:
             # exception catch all
-            print("Unknown exception")
-            data = [(d["data"][self.args.name_col], 0, 1, str(exc)) for d in doc_dicts]
-            print(data)
-            cur.executemany(
-                "INSERT INTO documents VALUES(?, ?, ? ,?) "
-                "ON CONFLICT (document_number) DO "
-                "UPDATE SET error=error+1, error_msg=excluded.error_msg",
-                data,
-            )
-            con.commit()
+            logger.exception("Unknown exception")
+            data = [(d["data"][self.args.name_col], str(exc)) for d in doc_dicts]
+            logger.debug(data)
+            self.log_errors(writes, data)
+        self.write_batch(con, writes)
 
     def dedupe(self):
         """
@@ -520,34 +1155,42 @@ class BatchUploader:
         Should not be needed, but is useful if something goes wrong and you
         accidently upload multiple copies of the same document
         """
-        client = documentcloud.DocumentCloud(
-            username=os.environ["DC_USERNAME"], password=os.environ["DC_PASSWORD"]
-        )
+        client = self.create_client()
         with open("dupes", encoding="utf8") as dupes:
-            for document_number in dupes:
-                print()
-                results = list(
-                    client.documents.search(
-                        f"project:{self.args.project_id}",
-                        **{f"data_{self.args.name_col}": document_number},
-                    )
-                )
-                if any(r.status == "success" for r in results):
-                    print("at least one success")
-                    first_success = [r for r in results if r.status == "success"][0]
-                    for result in results:
-                        if result == first_success:
-                            continue
-                        try:
-                            resp = client.delete(f"documents/{result.id}/")
-                            resp.raise_for_status()
-                        except (APIError, RequestException):
-                            print(f"error deleting {document_number}")
-                            break
+            document_numbers = {line.strip() for line in dupes if line.strip()}
+
+        def search(group):
+            try:
+                return group, self.search_documents(client, group, self.args.project_id)
+            except (APIError, RequestException) as exc:
+                logger.warning("error searching %s", exc)
+                return group, None
+
+        ids = []
+        search_errors = 0
+        with ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as executor:
+            for group, found in executor.map(
+                search, self.search_groups(document_numbers)
+            ):
+                if found is None:
+                    search_errors += len(group)
+                    continue
+                for document_number, results in found.items():
+                    if any(r.status == "success" for r in results):
+                        logger.info("at least one success %s", document_number)
+                        first_success = [r for r in results if r.status == "success"][0]
+                        ids.extend(r.id for r in results if r != first_success)
                     else:
-                        print("deleted successfully")
-                else:
-                    print(f"no success {document_number}")
+                        logger.info("no success %s", document_number)
+
+        # delete all of the other copies in bulk
+        failed = self.delete_documents(client, ids)
+        logger.info(
+            "deleted %d duplicates, %d errors, %d document numbers not searched",
+            len(ids) - len(failed),
+            len(failed),
+            search_errors,
+        )
 
     def main(self):
         """Entry point"""
@@ -555,29 +1198,27 @@ class BatchUploader:
         start = time.time()
 
         self.parse_arguments()
+        self.setup_logging()
 
         if self.args.generate_csv:
             self.generate_csv()
             return
 
+        if not os.path.exists(self.args.db_name):
+            self.create_db()
+        else:
+            self.migrate_db()
+
         if self.args.reupload_errors:
             self.reupload_error_files()
             self.reupload_error_files2()
             return
 
-        if not os.path.exists(self.args.db_name):
-            self.create_db()
-
         queue = Queue(maxsize=self.args.num_threads * self.args.batch_size * 2)
-        client = documentcloud.DocumentCloud(
-            username=os.environ["DC_USERNAME"], password=os.environ["DC_PASSWORD"]
-        )
+        client = self.create_client()
         event = Event()
 
-        uploaded_docs = self.get_documents_uploaded()
-        enqueue_thread = Thread(
-            target=self.enqueue_files, args=(queue, uploaded_docs, event)
-        )
+        enqueue_thread = Thread(target=self.enqueue_files, args=(queue, event))
         enqueue_thread.start()
         upload_threads = [
             Thread(target=self.upload_files_dc, args=(queue, client, event))
@@ -590,15 +1231,44 @@ class BatchUploader:
             for thread in upload_threads:
                 thread.join()
         except KeyboardInterrupt:
-            print("CTRL-C detected, shutting down gracefully")
+            logger.info("CTRL-C detected, shutting down gracefully")
             event.set()
             enqueue_thread.join()
             for thread in upload_threads:
                 thread.join()
 
+        if not event.is_set():
+            # let sqlite update the query planner statistics after the bulk
+            # inserts, which it only does for the tables which need it
+            con = self.connect_db()
+            con.execute("PRAGMA optimize")
+            con.close()
+
         end = time.time()
 
-        print("All done!", end - start, "seconds", self.args.num_threads, "threads")
+        logger.info(
+            "All done! %s seconds %d threads", end - start, self.args.num_threads
+        )
+
+    def setup_logging(self):
+        """
+        Set up logging
+
+        Log records are put on a queue and written out by a background thread,
+        so the upload threads do not block on, or contend for, writing to the
+        terminal.
+        """
+        log_queue = Queue()
+        handler = logging.StreamHandler()
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s %(threadName)s %(levelname)s %(message)s")
+        )
+        listener = QueueListener(log_queue, handler)
+        listener.start()
+        # make sure all queued records are written out before exiting
+        atexit.register(listener.stop)
+        logger.addHandler(QueueHandler(log_queue))
+        logger.setLevel(logging.DEBUG if self.args.verbose else logging.INFO)
 
     def parse_arguments(self):
         """Get argument data"""
@@ -665,6 +1335,12 @@ class BatchUploader:
             action="store_true",
             help="Re-upload files with errors during upload",
         )
+        parser.add_argument(
+            "-v",
+            "--verbose",
+            action="store_true",
+            help="Log the progress of each batch",
+        )
         self.args = parser.parse_args()
 
     def generate_csv(self):
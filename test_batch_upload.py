@@ -0,0 +1,45 @@
+"""Tests for batch_upload"""
+
+from unittest import mock
+
+import requests
+
+import batch_upload
+
+
+def make_response():
+    """A successful response, which is also accepted as a login response"""
+    response = requests.Response()
+    response.status_code = 200
+    response._content = b'{"access": "access", "refresh": "refresh"}'
+    return response
+
+
+def test_create_client_keeps_adapter(monkeypatch):
+    """The client's connection pool and retries are still used after a request"""
+    monkeypatch.setenv("DC_USERNAME", "username")
+    monkeypatch.setenv("DC_PASSWORD", "password")
+    with mock.patch.object(requests.Session, "send", return_value=make_response()):
+        client = batch_upload.BatchUploader().create_client()
+        url = client.base_uri
+        adapter = client.session.get_adapter(url)
+        client.get("documents/")
+
+    assert client.session.get_adapter(url) is adapter
+    assert adapter._pool_maxsize == batch_upload.SEARCH_WORKERS
+    assert 429 in adapter.max_retries.status_forcelist
+
+
+def test_duplicate_document_numbers(tmp_path):
+    """Every row for a duplicated document number is returned, whether the CSV
+    is scanned or indexed"""
+    path = tmp_path / "metadata.csv"
+    path.write_text("name,title\na.pdf,first\nb.pdf,other\na.pdf,second\n")
+    uploader = batch_upload.BatchUploader()
+    uploader.args = mock.Mock(csv=str(path), name_col="name")
+    expected = [["a.pdf", "first"], ["a.pdf", "second"]]
+
+    # the first lookup scans the file, later lookups use the index
+    assert uploader.get_rows_from_document_numbers(["a.pdf"]) == expected
+    assert uploader.get_rows_from_document_numbers(["a.pdf"]) == expected
+    assert uploader.csv_index["a.pdf"] == expected